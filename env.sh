@@ -1,5 +1,5 @@
-# Load Python 3.6.1
-module load python/3.6.1
+# Load Python 3.7.4 (the workflow requires Python 3.7 or newer)
+module load python/3.7.4
 
 # Load Python 2.7
 #module load python/2.7.16
@@ -27,15 +27,48 @@ import glob
 import traceback
 import argparse
 import json
+import copy
 import shutil
 import concurrent.futures
+import multiprocessing
 import threading
 import time
 from tqdm import tqdm
-from itertools import repeat
+
+# orjson is optional, it only speeds up the configuration parsing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from unifiedCSWFlow import workflow, DAL, ruptures
 
+################################################################################
+# Stage controllers (by name)
+STAGE_CLASSES = {cls.__name__: cls for cls in workflow.scriptABC.__subclasses__()}
+
+# CyberShake CFG file contents
+CFG_TEMPLATE = """\
+CS_PATH = %s
+SCRATCH_PATH = %s/scratch
+TMP_PATH = %s/tmp
+RUPTURE_ROOT = %s
+MPI_CMD = %s
+LOG_PATH = %s/logs
+"""
+
+# Configuration shared by all the sites run by a worker
+CONFIG = None
+
+# DB connection of the worker (opened once, reused by all its sites)
+DAL_HANDLE = None
+
+# Rupture files generated by all the workers (shown by the parent)
+RUPTURES_COUNTER = None
+
+# Modules loaded once by the fork server (inherited by every worker)
+PRELOAD = ["unifiedCSWFlow.DAL", "unifiedCSWFlow.workflow", "unifiedCSWFlow.ruptures"]
+
 ################################################################################
 # Methods and classes
 
@@ -62,21 +95,35 @@ def generateCyberShakeCFG(config):
     # Just for simplify
     path = config["output"]["cRunpath"]        
         
-    # Generate the CS CFG file
+    # Generate the CS CFG file (in a single write)
     with open(path + "/cybershake.cfg", 'w') as f:
-        f.write("CS_PATH = %s\n" % config["input"]["cyberShake"]["path"])
-        f.write("SCRATCH_PATH = %s\n" % (path + "/scratch"))
-        f.write("TMP_PATH = %s\n" % (path + "/tmp"))
-        f.write("RUPTURE_ROOT = %s\n" % config["input"]["ERF"]["ruptures"])
-        f.write("MPI_CMD = %s\n" % "srun")
-        f.write("LOG_PATH = %s\n" % (path + "/logs"))
+        f.write(CFG_TEMPLATE % (config["input"]["cyberShake"]["path"], path, path,
+                                config["input"]["ERF"]["ruptures"], "srun", path))
 
     # Copy the config.py (this avoids to modify the original config.py file)
     shutil.copyfile(config["input"]["cyberShake"]["path"] + "/config.py",
                     path + "/config.py")
 
-# Run site
-def runSite(config, runID, site):
+# Worker initialization (the configuration is sent once per worker, not per site)
+def initWorker(config, lock, counter):
+    global CONFIG, DAL_HANDLE, RUPTURES_COUNTER
+    CONFIG = config
+    RUPTURES_COUNTER = counter
+    DAL_HANDLE = DAL.SQLiteHandler(config["input"]["database"]["path"], readonly=True)
+    
+    # Share the progress bars lock with the parent
+    tqdm.set_lock(lock)
+
+# Show the rupture files generated by the workers (until stop is set)
+def showRuptures(pbar, counter, stop):
+    while not stop.wait(0.5):
+        pbar.set_postfix(ruptures=counter.value)
+
+# Run site (already registered in the DB)
+def runSite(runID, site, siteId):
+    # Each site works on its own copy of the configuration
+    config = copy.deepcopy(CONFIG)
+    
     # Obtain Thread ID
     #id = int(threading.current_thread().name.split("_")[-1])+1
     id = (runID%2+1)*2-1
@@ -84,13 +131,14 @@ def runSite(config, runID, site):
     # Show current site
     #print("#"*40 + "    " + site + "    " + "#"*40)
 
-    dal = DAL.SQLiteHandler(config["input"]["database"]["path"])
+    dal = DAL_HANDLE
     
     # Disable restart
     restartSite = False   
     
     # Create workflow    
-    wflow = workflow.Workflow()
+    wflow = workflow.Workflow(config)
+    stages = list(wflow)
     
     # Create the directory for the current run
     cRunPath = config["output"]["path"] + "/" + site + "_" + str(runID)
@@ -105,7 +153,7 @@ def runSite(config, runID, site):
             with open(stageFile, 'r') as f:
                 rstage = f.readlines()[0]
                 
-    if rstage and rstage == list(wflow)[-1]:
+    if rstage and rstage == stages[-1]:
         print("Skipping site " + site + "': Already done ")            
         return
                    
@@ -113,22 +161,6 @@ def runSite(config, runID, site):
     
     # Set the current path
     config["output"]["cRunpath"] = cRunPath
-                
-    # Obtain the Site ID for a given site name
-    siteId = dal.getSiteID(site)    
-                
-    # Check if the site do exist
-    if not siteId:
-        print("[ERROR] Skipping site '" + site + ": It was not found in the database", file=sys.stderr)
-        return
-    
-    # Just a shortcut
-    csetup = config["compute"]["setup"]
-        
-    # Insert the current run information onto the Database
-    dal.addRunInfo(runID, siteId, config["input"]["ERF"]["id"], 
-                   config["input"]["model"]["id"],
-                   csetup["sourceFrequency"], csetup["frequency"])
     
     # Store the ERF ID
     if not 'ruptures' in config["input"]["ERF"].keys():
@@ -141,22 +173,18 @@ def runSite(config, runID, site):
 
         fm = config["compute"]["setup"]["focalMechanism"]
         rupt.setFocalMechanism(fm["dip"], fm["strike"], fm["rake"])
-        rupt.generateRuptures(id, site)
+        rupt.generateRuptures(RUPTURES_COUNTER)
 
     # Write the CyberShake CFG file
     generateCyberShakeCFG(config)  
                     
-    pbar = tqdm(wflow, desc='[' + site + '] Running CyberShake task', 
-            position=id, total=len(list(wflow)), leave=False)
-    for stage in pbar:
-        
-        # Progress bar
-        pbar.set_description("[%s] Running stage '%s'" % (site, stage))
-        
-        # Check the start point
-        # NOTICE!!! Be careful using this feature, no control is taken about previous
-        #           assumed "done" steps
-        
+    # Obtain the controllers of the stages to be run
+    # NOTICE!!! Be careful using the restart feature, no control is taken about previous
+    #           assumed "done" steps
+    siteSN = dal.getSiteShortName(site)
+    controllers = {}
+    for stage in stages:
+        # Check the start point (stages up to the last one done are skipped)
         if rstage:
             if stage == rstage:
                 #print("Starting after stage " + stage)
@@ -165,12 +193,28 @@ def runSite(config, runID, site):
                 #print("Skipping stage " + stage)
             continue
         
-        # Obtain the current stage's controller
-        siteSN = dal.getSiteShortName(site)
-        stage = eval("workflow." + stage)(config, id+1, runID, siteSN)
+        controllers[stage] = STAGE_CLASSES[stage](config, id+1, runID, siteSN, workflow=wflow)
+    
+    # Built all the stages scripts at once (they do not depend on each other)
+    wflow.buildAll(controllers.values())
+    
+    # Progress bar descriptions (built once, the bar is redrawn at most once per second)
+    descs = ["[%s] Running stage '%s'" % (site, stage) for stage in stages]
+    # (only the sites on the first position are drawn)
+    pbar = tqdm(stages, desc='[' + site + '] Running CyberShake task', 
+            position=id, total=len(stages), leave=False, mininterval=1.0, miniters=1,
+            disable=(id != 1))
+    for i, stage in enumerate(pbar):
+        
+        # Progress bar
+        pbar.set_description(descs[i], refresh=False)
         
-        # Built the curent stage script
-        stage.build()
+        # Skip the stages already done
+        if stage not in controllers:
+            continue
+        
+        # Obtain the current stage's controller
+        stage = controllers[stage]
         
         # Run the stage
         stage.run()
@@ -191,8 +235,8 @@ def main():
         print("#"*40 + "   Preprocess (setup from: " + args.config + ")  " + "#"*40)
         
         # Read the configuration file
-        with open(args.config, 'r') as f:
-            config = json.load(f)    
+        with open(args.config, 'rb') as f:
+            config = orjson.loads(f.read()) if orjson else json.load(f)
                     
         # Create the base directory for the run and enter in it
         workSpace = os.path.abspath(config["output"]["path"])
@@ -211,12 +255,18 @@ def main():
         if db["populate"]:
             dal.importData(db["importFrom"])
         
+        # Make sure the lookups are indexed
+        dal.ensureIndexes()
+        
         # Obtain a valid starting point RunID from DataBase
         runID = dal.getValidRunId()
         if config["compute"]["restart"]:
-            tmpids = [i.split("_")[-1] for i in glob.glob(config["output"]["path"]+"/*[0-9]")]
-            if tmpids:
-              runID = int(min([i.split("_")[-1] for i in glob.glob(config["output"]["path"]+"/*[0-9]")]))
+            runs = glob.glob(config["output"]["path"] + "/*[0-9]")
+            
+            # Only the site directories (<site>_<runID>) are taken into account
+            ids = [suffix for suffix in (run.rsplit("_", 1)[-1] for run in runs) if suffix.isdigit()]
+            if ids:
+                runID = min(map(int, ids))
         
         # Obtain both model and ERF IDs 
         modelID = dal.getModelID(config["input"]["model"]["name"])
@@ -236,17 +286,63 @@ def main():
 
         # For each Site defined as input
         runIDs = []
-        i = 0;
-        for site in config["input"]["sites"]:
+        sites = []
+        siteIds = []
+        for i, site in enumerate(config["input"]["sites"]):
+            # Obtain the Site ID for a given site name
+            siteId = dal.getSiteID(site)
+            
+            # Check if the site do exist
+            if not siteId:
+                print("[ERROR] Skipping site '" + site + ": It was not found in the database", file=sys.stderr)
+                continue
+            
             runIDs.append(runID+i)
-            i = i + 1
+            sites.append(site)
+            siteIds.append(siteId)
+        
+        # Just a shortcut
+        csetup = config["compute"]["setup"]
+        
+        # Insert the runs information onto the Database (all at once)
+        dal.addRunsInfo(zip(runIDs, siteIds), erfID, modelID,
+                        csetup["sourceFrequency"], csetup["frequency"])
+
+        # Workers are forked from a server with the package already imported
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(PRELOAD)
+        
+        # The progress bars lock must belong to the same context
+        lock = ctx.RLock()
+        tqdm.set_lock(lock)
+        
+        # Rupture files generated by the workers
+        counter = ctx.Value('i', 0)
 
 #        with concurrent.futures.ThreadPoolExecutor(max_workers=config["compute"]['workers']) as executor:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=config["compute"]['workers']) as executor:
-            results = list(tqdm(executor.map(runSite, repeat(config),
-                                runIDs, config["input"]["sites"]), 
-                                total=len(config["input"]["sites"]), position=0,
-                                desc='[Sites simulation progress]'))                     
+        with concurrent.futures.ProcessPoolExecutor(max_workers=config["compute"]['workers'],
+                                                    mp_context=ctx,
+                                                    initializer=initWorker,
+                                                    initargs=(config, lock, counter)) as executor:
+            # (the bar is updated by hand, tqdm would close it as soon as the sites are done)
+            pbar = tqdm(total=len(sites), position=0, desc='[Sites simulation progress]')
+            
+            # The workers progress is polled from here
+            stop = threading.Event()
+            monitor = threading.Thread(target=showRuptures, args=(pbar, counter, stop), daemon=True)
+            monitor.start()
+            results = []
+            try:
+                for result in executor.map(runSite, runIDs, sites, siteIds):
+                    results.append(result)
+                    pbar.update()
+            finally:
+                stop.set()
+                monitor.join()
+                
+                # Show the final count (the last poll could be outdated)
+                pbar.set_postfix(ruptures=counter.value)
+                pbar.close()
                             
     except Exception as error:
         print("Exception in code:")
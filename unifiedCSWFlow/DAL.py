@@ -22,8 +22,67 @@
 ################################################################################
 # Module imports
 import os
+import csv
 import sqlite3
-from datetime import datetime
+import time
+import urllib.parse
+
+################################################################################
+# Queries (kept as constants so sqlite3 reuses the compiled statements)
+Q_VALID_RUN_ID = "select max(Run_ID) from CyberShake_Runs;"
+
+# Runs already registered (restarts) are skipped
+Q_ADD_RUN = "insert or ignore into CyberShake_Runs(Run_Id, Site_ID, ERF_ID, SGT_Variation_ID, Velocity_Model_ID,\
+ Rup_Var_Scenario_ID, Status, Status_Time, Last_User, Max_Frequency, Low_Frequency_Cutoff,\
+ SGT_Source_Filter_Frequency) values (?, ?, ?, 1, ?, 1, 'SGT Started', ?, 'BSC', ?, ?, ?);"
+
+# Sites are looked up by name or short name (two indexed probes)
+Q_SITE = "select %s from CyberShake_Sites where CS_Site_Name=? union all \
+select %s from CyberShake_Sites where CS_Short_Name=?;"
+
+Q_SITE_ID = Q_SITE % (("CS_Site_ID",) * 2)
+
+Q_SITE_LOCATION = Q_SITE % (("CS_Site_Lat, CS_Site_Lon",) * 2)
+
+Q_SITE_SHORT_NAME = Q_SITE % (("CS_Short_Name",) * 2)
+
+Q_MODEL_ID = "select Velocity_Model_ID from Velocity_Models where Velocity_Model_Name=?;"
+
+Q_ERF_ID = "select ERF_ID from ERF_IDs where ERF_Name like ?;"
+
+Q_RUPTURES = "select * from Ruptures order by Source_ID, Rupture_ID;"
+
+Q_RUPTURES_COLUMNS = "select %s from Ruptures order by Source_ID, Rupture_ID;"
+
+Q_RUN_ID_INFO = "select ERF_ID, Rup_Var_Scenario_ID, SGT_Variation_ID, Velocity_Model_ID\
+ from CyberShake_Runs where Run_ID=?;"
+
+Q_ADD_HAZARD_DATASET = "insert into Hazard_Datasets (ERF_ID, Rup_Var_Scenario_ID, SGT_Variation_ID,\
+ Velocity_Model_ID, Prob_Model_ID, Time_Span_ID, Max_Frequency, Low_Frequency_Cutoff) values\
+ (?, ?, ?, ?, 1, 1, ?, ?);"
+
+Q_RUPTURE_FILE = "select r.ERF_ID, rv.Rup_Var_Scenario_ID, r.Source_ID, r.Rupture_ID,\
+ count(*) as Count, r.Num_Points, r.Mag from Ruptures as r inner join Rupture_Variations as rv on\
+ r.Source_ID=rv.Source_ID and r.Rupture_ID = rv.Rupture_ID group by r.Source_ID, r.Rupture_ID;"
+
+Q_RUPTURE_FILE_COUNT = "select count(*) from (select 1 from Ruptures as r inner join\
+ Rupture_Variations as rv on r.Source_ID=rv.Source_ID and r.Rupture_ID = rv.Rupture_ID group by\
+ r.Source_ID, r.Rupture_ID);"
+
+# Rows already present are skipped, as the DB could be populated more than once
+Q_IMPORT = "insert or ignore into %s (%s) values (%s);"
+
+# Indexes for the site lookups and the ruptures joins (CS_Short_Name is already
+# indexed, as it is unique)
+INDEXES = ("create index if not exists idx_sites_name on CyberShake_Sites(CS_Site_Name);",
+           "create index if not exists idx_rv_src_rup on Rupture_Variations(Source_ID, Rupture_ID);",
+           "create index if not exists idx_rup_src_rup on Ruptures(Source_ID, Rupture_ID);")
+
+# Connection setup (a 256MB page cache). Neither WAL nor memory mapped I/O are used, as
+# they only work when all the processes using the DB are on the same host (the DB is
+# also used by the Slurm jobs and the Java tools, over GPFS)
+PRAGMAS = ("PRAGMA cache_size=-262144;",
+           "PRAGMA temp_store=MEMORY;")
 
 ################################################################################
 # Methods and classes
@@ -38,19 +97,31 @@ def dict_factory(cursor, row):
 class SQLiteHandler():
     
     # Initialization method
-    def __init__(self, path, dict_factory = False):
-        self.connection = sqlite3.connect(path, check_same_thread=False)
+    def __init__(self, path, dict_factory = False, readonly = False):
+        if readonly:
+            # Read-only connection (the DB must already exist)
+            uri = "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro"
+            self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
         
         if dict_factory:
             self.connection.row_factory = self._dict_factory
         
         self.cursor = self.connection.cursor()
         
+        # Cursor for the single value queries (not affected by the row factory)
+        self.scalarCursor = self.connection.cursor()
+        self.scalarCursor.row_factory = None
+        
+        # Tune the connection
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
+        
     # Obtain a valid Run Identifier
     def getValidRunId(self):
-        # Define the query
-        query = "select max(Run_ID) from CyberShake_Runs;"
-        self.cursor.execute(query);
+        # Execute query
+        self.cursor.execute(Q_VALID_RUN_ID)
         
         # Obtain the RunId
         row = self.cursor.fetchone()
@@ -64,48 +135,30 @@ class SQLiteHandler():
 
     # Insert a row onto the Runs table
     def addRunInfo(self, runID, siteID, erfID, modelID, sfreq, freq):
+        self.addRunsInfo([(runID, siteID)], erfID, modelID, sfreq, freq)
+
+    # Insert a row per (runID, siteID) pair onto the Runs table (single transaction)
+    def addRunsInfo(self, runs, erfID, modelID, sfreq, freq):
         
-        # Define the query
-        query = "insert into CyberShake_Runs(Run_Id, Site_ID, ERF_ID, SGT_Variation_ID, Velocity_Model_ID,\
- Rup_Var_Scenario_ID, Status, Status_Time, Last_User, Max_Frequency, Low_Frequency_Cutoff,\
- SGT_Source_Filter_Frequency) values ("
- 
-        # Date
-        date = datetime.now().strftime("%Y-0%m-%d %H:%M:%S")
-        
-        # Build the rest of the query
-        query = query + str(runID) + ', ' + str(siteID) + ', ' + str(erfID) + ', 1, ' + str(modelID)
-        query = query + ', 1, "SGT Started", "' + date + '", "BSC", ' 
-        query = query + str(freq) + ', ' + str(freq) + ', ' + str(sfreq) + ');'
+        # Date (the same one for all the runs of the transaction)
+        date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
         
         # Execute query
-        try:
-            self.cursor.execute(query);
-        except sqlite3.IntegrityError:
-            pass        
-        
-        # Commit the transaction
-        self.connection.commit()
+        with self.connection:
+            self.cursor.executemany(Q_ADD_RUN, ((runID, siteID, erfID, modelID, date,
+                                                 freq, freq, sfreq) for runID, siteID in runs))
 
     # Obtain a site ID given its name (or shortname)
     def getSiteID(self, site):
         
-        # Define the query
-        query = 'select CS_Site_ID from CyberShake_Sites where CS_Site_Name=="' + site \
-                + '" or CS_Short_Name=="' + site + '";'
-
         # Execute query
-        return self._runQuery(query)
+        return self._runQuery(Q_SITE_ID, (site, site))
     
     # Obtain geographical position for a given site    
     def getSiteLocation(self, site):
         
-        # Define the query
-        query = 'select CS_Site_Lat, CS_Site_Lon from CyberShake_Sites where CS_Site_Name=="' + site \
-                + '" or CS_Short_Name=="' + site + '";'
-
         # Execute query
-        self.cursor.execute(query);
+        self.cursor.execute(Q_SITE_LOCATION, (site, site))
         
         # Obtain the RunId
         row = self.cursor.fetchone()
@@ -115,53 +168,41 @@ class SQLiteHandler():
     # Obtain a site ID given its name (or shortname)
     def getSiteShortName(self, site):
         
-        # Define the query
-        query = 'select CS_Short_Name from CyberShake_Sites where CS_Site_Name=="' + site \
-                + '" or CS_Short_Name=="' + site + '";'
-
         # Execute query
-        return self._runQuery(query)
+        return self._runQuery(Q_SITE_SHORT_NAME, (site, site))
         
     # Obtain a site ID given its name (or shortname)
     def getModelID(self, model):
         
-        # Define the query
-        query = 'select Velocity_Model_ID from Velocity_Models where Velocity_Model_Name=="' + model \
-                + '";'
-
         # Execute query
-        return self._runQuery(query)
+        return self._runQuery(Q_MODEL_ID, (model,))
 
     # Obtain a ERF ID given its name (or shortname)
     def getERFID(self, erf):
-        # Define the query
-        query = 'select ERF_ID from ERF_IDs where ERF_Name like "%' + erf + '%";'
-        
         # Execute query
-        return self._runQuery(query)
+        return self._runQuery(Q_ERF_ID, ('%' + erf + '%',))
 
-    # Obtain the ruptures from the DB
+    # Obtain the ruptures from the DB (a dedicated cursor is returned for streaming them)
     def getRupturesDict(self):
-        # Define the query
-        query = 'select * from Ruptures;'
-
         # Execute query
-        self.cursor.execute(query);
-        
-        # Obtain the RunId
-        row = self.cursor.fetchall()
+        return self.connection.execute(Q_RUPTURES)
 
-        return row
+    # Obtain the given columns of all the ruptures in the DB (a tuple per column)
+    def getRupturesColumns(self, columns):
+        # Execute query (rows are fetched as plain tuples)
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(Q_RUPTURES_COLUMNS % ", ".join(columns)).fetchall()
+        
+        # Transpose the rows
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        return dict(zip(columns, values))
 
 
     # Obtain information for a given RunID
     def getRunIDInfo(self, runID):        
-        # Define the query        
-        query = "select ERF_ID, Rup_Var_Scenario_ID, SGT_Variation_ID, Velocity_Model_ID\
-         from CyberShake_Runs where Run_ID=" + str(runID)
-         
         # Execute query
-        self.cursor.execute(query);        
+        self.cursor.execute(Q_RUN_ID_INFO, (runID,))
         
         # Obtain the RunId
         row = self.cursor.fetchone()
@@ -171,17 +212,10 @@ class SQLiteHandler():
     # Insert a hazard dataset
     def addHazardDataset(self, erfID, rupVarScenarioID, SGTID, velModelID, freq):
         
-        # Define the query
-        query = "insert into Hazard_Datasets (ERF_ID, Rup_Var_Scenario_ID, SGT_Variation_ID,\
- Velocity_Model_ID, Prob_Model_ID, Time_Span_ID, Max_Frequency, Low_Frequency_Cutoff) values ("
-         
-        # Build the rest of the query
-        query = query + str(erfID) + ', ' + str(rupVarScenarioID) + ', ' + str(SGTID) + ', ' \
-                + str(velModelID) + ', 1, 1, ' + str(freq) + ', ' + str(freq) + ');'
-
         # Execute query
         try:
-            self.cursor.execute(query);
+            self.cursor.execute(Q_ADD_HAZARD_DATASET, (erfID, rupVarScenarioID, SGTID,
+                                                       velModelID, freq, freq))
         except sqlite3.IntegrityError:
             pass        
         
@@ -190,19 +224,13 @@ class SQLiteHandler():
     
     # Generate a rupture file
     def generateRuptureFile(self, file):
-        # Define the query
-        query = 'select r.ERF_ID, rv.Rup_Var_Scenario_ID, r.Source_ID, r.Rupture_ID,\
- count(*) as Count, r.Num_Points, r.Mag from Ruptures as r inner join Rupture_Variations as rv on\
- r.Source_ID=rv.Source_ID and r.Rupture_ID = rv.Rupture_ID group by r.Source_ID, r.Rupture_ID;'
- 
-        # Execute query
-        self.cursor.execute(query);
-         
-        # Obtain the RunId
-        rows = self.cursor.fetchall()
-    
         # Obtain the number of rows
-        count = len(list(rows))
+        count = self._runQuery(Q_RUPTURE_FILE_COUNT)
+        
+        # Execute query (rows are streamed as plain tuples)
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(Q_RUPTURE_FILE)
         
         # Generate the rupture file list
         with open(file, 'w') as rup:
@@ -210,50 +238,42 @@ class SQLiteHandler():
             rup.write(str(count) + "\n")
             
             # For each row
-            for r in rows:
-                rup.write("e" + str(r["ERF_ID"]) + "_rv" + str(r["Rup_Var_Scenario_ID"]) + "_" \
-                + str(r["Source_ID"]) + "_" + str(r["Rupture_ID"]) + ".txt " + str(r["Count"])\
-                + " 1 " + str(r["Num_Points"]) + " " + str(r["Mag"]) + "\n")
-        pass
+            rup.writelines(f"e{erf}_rv{rv}_{src}_{rupture}.txt {variations} 1 {npoints} {mag}\n"
+                           for erf, rv, src, rupture, variations, npoints, mag in cursor)
         
     # Import data for a directory contaning a .csv per table
     def importData(self, path):
-        # Define the query
-        queryHeader = "insert into "
-        
-        # For each file in the provided path
-        for file in os.listdir(path):
-            queryWhere = os.path.splitext(os.path.basename(file))[0]
-                        
-            # Read the file
-            with open(path + "/" + file, 'r') as f:
-                lines = f.read().splitlines()
-                
-            queryWhat = " (" + lines[0] + ")"
-            
-            # Buidl and insert the current tuple
-            for values in lines[1:]:
-                # Build query
-                values = values.replace(",", "','")
-                query = queryHeader + queryWhere + queryWhat + " values ('" + values + "');"
-                                                
-                # Execute query
-                try:
-                    self.cursor.execute(query);
-                except sqlite3.IntegrityError:
-                    pass
+        # The whole import is done in a single transaction
+        with self.connection:
+            # For each file in the provided path
+            for file in os.listdir(path):
+                table = os.path.splitext(os.path.basename(file))[0]
+                            
+                # Read the file
+                with open(path + "/" + file, 'r', newline='') as f:
+                    rows = csv.reader(f)
+                    header = next(rows)
+                    
+                    # Build the query once per table
+                    query = Q_IMPORT % (table, ",".join(header), ",".join("?" * len(header)))
                     
-            # Commit the transaction
-            self.connection.commit()
+                    # Insert all the tuples (empty lines are skipped)
+                    self.cursor.executemany(query, (row for row in rows if row))
                             
         
+    # Create the indexes needed by the queries (if they do not exist yet)
+    def ensureIndexes(self):
+        with self.connection:
+            for index in INDEXES:
+                self.cursor.execute(index)
+        
     # Query the DB
-    def _runQuery(self, query):
+    def _runQuery(self, query, params=()):
         # Execute query
-        self.cursor.execute(query);
+        self.scalarCursor.execute(query, params)
         
         # Obtain the RunId
-        row = self.cursor.fetchone()                
+        row = self.scalarCursor.fetchone()
         
         # Just check if the DB is empty
         return row[0] if row else None
@@ -22,15 +22,106 @@
 ################################################################################
 # Module imports
 import os
+import io
 import sqlite3
 import numpy as np
-from tqdm import tqdm
+
+# Numba is optional, without it the axis generation runs as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda function: function
 
 from unifiedCSWFlow import DAL
 
+################################################################################
+# Ruptures columns used to generate the rupture files
+INT_COLUMNS = ("Source_ID", "Rupture_ID", "Num_Rows", "Num_Columns")
+
+FLOAT_COLUMNS = ("Prob", "Mag", "Grid_Spacing", "Start_Lat", "End_Lat", "Start_Lon",
+                 "End_Lon", "Start_Depth", "End_Depth")
+
+# Rupture files added at once to the shared counter (its lock is shared by all the workers)
+COUNTER_BATCH = 64
+
 ################################################################################
 # Methods and classes
 
+# Quantize a step to the given precision (truncating it)
+def _quantize(step, prec):
+    prec = 1/prec
+    return int(step *prec)/prec
+
+# Generate axis (num points from ini towards end, separated by a uniform step)
+@njit(cache=True)
+def _gen_axis(ini, end, step, num):
+    # Walk from ini towards end (a constant axis keeps all the points equal to ini)
+    if end < ini:
+        step = -step
+    elif end == ini:
+        step = 0.0
+    delta = (ini + step) - ini
+    
+    axis = np.empty(num)
+    for k in range(num):
+        axis[k] = ini + k*delta
+    
+    return axis
+
+# Write a whole file with (usually) a single system call
+def _writeFile(file, data):
+    fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    
+# Generate a rupture file (only plain values are used, no DB rows)
+def _writeRupture(file, prob, mag, spacing, numRows, numCols, slat, elat, slon, elon,
+                  sdepth, edepth, rake, dip, strike):
+    # The rupture is rendered in memory and written at once
+    rup = io.StringIO()
+    
+    # Dumping header information
+    rup.write("Probability = " + str(prob) + "\n")
+    rup.write("Magnitude = " + str(mag) + "\n")
+    rup.write("GridSpacing = " + str(spacing) + "\n")
+    rup.write("NumRows = " + str(numRows) + "\n")
+    rup.write("NumCols = " + str(numCols) + "\n")
+    rup.write("#   Lat         Lon         Depth      Rake    Dip     Strike\n")
+
+    ncols = int(numCols)
+    nrows = int(numRows)
+
+    #sphereDist = haversine((x2, y1), (x1, y2)) * 1000
+    #print(str(round((sphereDist/200) + 0.5)) + " " + str(numCols))
+
+    # Generate the 3 axis points (NumCols points along the fault trace and NumRows points
+    # down dip, separated by the grid spacing)
+    segments = max(ncols-1, 1)
+    x = _gen_axis(slat, elat, _quantize(abs(elat-slat)/segments, 1e-10), ncols)
+    y = _gen_axis(slon, elon, _quantize(abs(elon-slon)/segments, 1e-10), ncols)
+    z = _gen_axis(sdepth, edepth, float(spacing), nrows)
+
+    # Build the whole grid (one row per point, depth being the slowest axis)
+    grid = np.column_stack([np.tile(x, nrows),
+                            np.tile(y, nrows),
+                            np.repeat(z, ncols)])
+
+    # The focal mechanism is the same for every point (formatted only once)
+    tail = "    ".join(str(value) for value in (rake, dip, strike))
+
+    # Dumping the ruptures (the whole grid is formatted by a single operation, instead of
+    # a Python loop per row)
+    row = "    ".join(["%s"] * 3 + [tail]) + "\n"
+    rup.write((row * len(grid)) % tuple(grid.ravel().tolist()))
+
+    # Write the rupture file
+    _writeFile(file, rup.getvalue().encode())
+
 # Rupture generator
 class Ruptures():
     # Initialization method
@@ -41,95 +132,68 @@ class Ruptures():
         # Initialze focal mechanism
         self.fm = {"dip": 0.0, "strike": 0.0, "rake": 0.0}
         
-        # Create DB  sconnection        
-        self.dal = DAL.SQLiteHandler(database, True)
+        # Create DB  sconnection (only read)
+        self.dal = DAL.SQLiteHandler(database, True, readonly=True)
         
     # Set the focal mechanism
     def setFocalMechanism(self, dip, strike, rake):
         self.fm = {"dip": dip, "strike": strike, "rake": rake}
         
-    # Generate ruptures
-    def generateRuptures(self, id, site):
-
-        # Obtain all ruptures in the DB
-        rows = self.dal.getRupturesDict()
-        count = len(list(rows))
-                
-        # For each Rupture found
-        pbar = tqdm(rows, desc='[' + site +'] Generating rupture files', total=count, position=id, leave=False)
-        for row in pbar:
-            # Creating output directory
-            path = "%s/%s/%s" % (self.opath, row['Source_ID'], row['Rupture_ID']);
-            if os.path.isdir(path):
-               continue
-            os.makedirs(path, exist_ok=True)
-
-            # Building the filename
-            file = "%s_%s.txt"% (row['Source_ID'], row['Rupture_ID'])
-
-            #pbar.set_description("Generating rupture files --> %s/%s" % (path, file))
-            #print("Generating file: " + path + "/" + file)
-
-            # Generate the rupture
-            with open(path + "/" + file, 'w') as rup:
-                # Dumping header information
-                rup.write("Probability = " + str(row['Prob']) + "\n")
-                rup.write("Magnitude = " + str(row['Mag']) + "\n")
-                rup.write("GridSpacing = " + str(row['Grid_Spacing']) + "\n")
-                rup.write("NumRows = " + str(row['Num_Rows']) + "\n")
-                rup.write("NumCols = " + str(row['Num_Columns']) + "\n")
-                rup.write("#   Lat         Lon         Depth      Rake    Dip     Strike\n")
-
-                ncols = int(row['Num_Columns'])-1
-                nrows = int(row['Num_Rows'])-1
-
-                #sphereDist = haversine((x2, y1), (x1, y2)) * 1000
-                #print(str(round((sphereDist/200) + 0.5)) + " " + str(row['Num_Columns']))
-
-                slat = float(row['Start_Lat'])
-                elat = float(row['End_Lat'])
-                slon = float(row['Start_Lon'])
-                elon = float(row['End_Lon'])
-                sdepth = float(row['Start_Depth'])
-                edepth = float(row['End_Depth'])
-
-                # Generate the 3 axis points
-                x = self._generateAxis(slat, elat, 0, ncols, 1e-10)
-                y = self._generateAxis(slon, elon, 0, ncols, 1e-10)
-                z = self._generateAxis(sdepth, edepth, 0, nrows, 1e-2)
-
-                # Write to file the ruptures
-                s =  "    "
-                for j in z:
-                    for i in np.arange(0, ncols):
-                        rup.write(str(x[i]) + s + str(y[i]) + s + str(j) + s + str(self.fm['rake'])\
-                         + s + str(self.fm['dip']) + s + str(self.fm['strike']) + "\n")
-
-            
-    # Generate axis
-    def _generateAxis(self, ini, end, offset, num, prec):
-        # Calculate the step
-        step = abs(end-ini) / num
-
-        prec = 1/prec
-        step = int(step *prec)/prec
-
-        # Generate the axis
-        if ini == end:
-            axis = np.repeat(ini, num)
-        elif ini < end:
-            axis = np.arange(ini+offset, end, step)
-        else:
-            axis = np.arange(end+offset, ini, step)
-
-        return axis        
+    # Generate ruptures (the generated files are added to the shared counter, if any)
+    def generateRuptures(self, counter=None):
+
+        # Obtain all ruptures in the DB (an array per column)
+        columns = self.dal.getRupturesColumns(INT_COLUMNS + FLOAT_COLUMNS)
+        cols = {name: np.asarray(values, dtype=np.int64 if name in INT_COLUMNS else np.float64)
+                for name, values in columns.items()}
+        count = len(cols["Source_ID"])
+        
+        # For each Rupture found (only the files actually written are counted)
+        written = 0
+        for k, rupture in enumerate(self._prepareRuptures(cols, count), 1):
+            if self._emit(rupture):
+                written += 1
             
-    
-    
+            # The counter is updated in batches (and once the last rupture is done)
+            if counter is not None and written and (k % COUNTER_BATCH == 0 or k == count):
+                with counter.get_lock():
+                    counter.value += written
+                written = 0
         
+    # Prepare the ruptures to be generated (only plain values are passed to the writer)
+    def _prepareRuptures(self, cols, count):
+        # Just a shortcut
+        srcs, rups = cols['Source_ID'], cols['Rupture_ID']
+        
+        sources = set()
+        for k in range(count):
+            # Creating the source directory (only once per source)
+            source = "%s/%s" % (self.opath, srcs[k])
+            if source not in sources:
+                os.makedirs(source, exist_ok=True)
+                sources.add(source)
+            
+            # Output directory and filename
+            path = "%s/%s" % (source, rups[k])
+            file = "%s/%s_%s.txt"% (path, srcs[k], rups[k])
+            
+            yield (path, (file, cols['Prob'][k], cols['Mag'][k], cols['Grid_Spacing'][k],
+                          cols['Num_Rows'][k], cols['Num_Columns'][k],
+                          cols['Start_Lat'][k], cols['End_Lat'][k],
+                          cols['Start_Lon'][k], cols['End_Lon'][k],
+                          cols['Start_Depth'][k], cols['End_Depth'][k],
+                          self.fm['rake'], self.fm['dip'], self.fm['strike']))
     
+    # Generate a single rupture (False if it was already generated)
+    def _emit(self, rupture):
+        path, values = rupture
         
+        # Creating output directory (already generated ruptures are skipped)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            return False
         
-    
-          
-    
+        # Generate the rupture
+        _writeRupture(*values)
+        return True
@@ -22,17 +22,62 @@
 ################################################################################
 # Module imports
 import os
+import re
 import time
 import subprocess
 import threading
+import asyncio
 import math
+import collections
+import functools
+import concurrent.futures
 from tqdm import tqdm
 from abc import ABC, abstractmethod
 
 from unifiedCSWFlow import DAL
 
+################################################################################
+# Slurm commands (the job ID is appended)
+SQUEUE_ARGV = ['squeue', '-h', '-o', 'Slurm job %T (%M of %l)', '--job']
+
+# Job ID printed by sbatch ("Submitted batch job <id>[ on cluster <name>]")
+JOB_ID = re.compile(r"\d+")
+
+# Environment setup shared by several stage scripts
+PY27 = "module load python/2.7.16\n"
+
+MOD_SWAP = "module swap intel gcc\nulimit -c unlimited\n"
+
+# ERF description used by the curves plotter (relative to the CyberShake path)
+XML_PATH = "/OpenSHA//opensha-cybershake/src/org/opensha/sha/cybershake/conf/MeanICERF.xml"
+
+# ... and its fixed options
+CURVE_OPTIONS = "--type pdf,png --force-add --cmp RotD50"
+
+# Commands run by the clean up stage
+CLEANUP_LINES = ("rm -fr *sgt", "rm -fr comp_*/output_sgt/*")
+
+################################################################################
+# Compute resources requested for the stages (as given in the configuration)
+ResourceSpec = collections.namedtuple('ResourceSpec', 'time nodes tasks cpus qos')
+
 ################################################################################
 # Methods and classes
+
+# Format a time limit (in seconds) as HH:MM:SS (several stages share the same limit)
+@functools.lru_cache(maxsize=32)
+def _hms(sec):
+    return time.strftime('%H:%M:%S', time.gmtime(sec))
+
+# Format the periods as a comma separated list (the same ones are used by several stages)
+@functools.lru_cache(maxsize=8)
+def _periodsCSV(periods):
+    return ",".join(map(str, periods))
+
+# Obtain the compute resources from the configuration
+def getResources(config):
+    r = config["compute"]["resources"]
+    return ResourceSpec(r["time"], r["nodes"], r["task-per-node"], r["cpus-per-task"], r["qos"])
         
 # CyberShake main Workflow definition for one site
 class Workflow():
@@ -43,43 +88,72 @@ class Workflow():
                "radiusfile": "radiusfile",
                "coordfile": "coordfile"}
                    
-    # Initialization method
-    def __init__(self):
+    # Stages run for every site (shared by all the workflows)
 # Complete (Original Cybershake workflow)
-#       self.wf = [
-#            'preSGT',
-#            'preAWP',
-#            'AWPX',
-#            'AWPY',
-#            'checkX',
-#            'checkY',
-#            'postX',
-#            'postY',
-#            'rupVar',                                                                                                                                                                                             
-#            'runDS',
-#            'insertDB',
-#            'checkDB',
-#            'curveCalc',
-#            'cleanUp'
-#       ]
-
-        self.wf = [ 
-            'preSGT',
-            'preAWP',
-            'AWPX',
-            'AWPY',
-            'checkX',
-            'checkY',
-            'postX',
-            'postY',
-            'rupVar',
-            'runDS',
-            'cleanUp'
-        ]   
+#   WF = (
+#       'preSGT',
+#       'preAWP',
+#       'AWPX',
+#       'AWPY',
+#       'checkX',
+#       'checkY',
+#       'postX',
+#       'postY',
+#       'rupVar',
+#       'runDS',
+#       'insertDB',
+#       'checkDB',
+#       'curveCalc',
+#       'cleanUp'
+#   )
+
+    WF = (
+        'preSGT',
+        'preAWP',
+        'AWPX',
+        'AWPY',
+        'checkX',
+        'checkY',
+        'postX',
+        'postY',
+        'rupVar',
+        'runDS',
+        'cleanUp'
+    )
+                   
+    # Initialization method (the compute resources are read once per workflow)
+    def __init__(self, config=None):
+        self.config = config
+        self.resources = getResources(config) if config else None
+        
+        # DB connection shared by the stages (see 'dal')
+        self.lock = threading.RLock()
+        self._dal = None
+        
+    # DB connection (opened on first use, access must hold 'lock')
+    @property
+    def dal(self):
+        with self.lock:
+            if self._dal is None:
+                self._dal = DAL.SQLiteHandler(self.config["input"]["database"]["path"], True)
+            return self._dal
                 
+    # Build the scripts of the given stages (concurrently, as they only write their own
+    # script file)
+    def buildAll(self, stages):
+        stages = list(stages)
+        if not stages:
+            return
+        
+        workers = min(len(stages), os.cpu_count())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # Errors in any of the builds are raised here
+            for job in [executor.submit(stage.build) for stage in stages]:
+                job.result()
+        
     # Define the iterator    
     def __iter__(self):
-        return iter(self.wf)
+        return iter(self.WF)
         
 # Abstract class for defining a common interface between all workflow stages
 class scriptABC(ABC):
@@ -92,11 +166,14 @@ class scriptABC(ABC):
         return NotImplementedError
             
     # Initialization method
-    def __init__(self, config, id, runID, site):
+    def __init__(self, config, id, runID, site, resources=None, workflow=None):
         self.lines = []
         self.config = config
+        self.workflow = workflow or Workflow(config)
+        self.resources = resources or self.workflow.resources
         self.runID = runID
         self.site = site
+        self.files = {k: f"{site}.{v}" for k, v in Workflow.OUTPUTS.items()}
         self.time = 1
         self.id = id
                 
@@ -108,60 +185,109 @@ class scriptABC(ABC):
     def postprocess(self):
         raise NotImplementedError("Error: 'postprocess' method should be implemented")        
             
-    # Just a class method for obtaining the class name
-    @classmethod
-    def _className(cls):
-        return(cls.__name__)
+    # The class name of every stage is stored once, when the stage is defined
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.cname = cls.__name__
+        
+        # Tag written to the restart file once the stage is done
+        cls.tag = cls.__name__.encode()
+
+    # Common script header
+    _HEADER = "#!/bin/bash\n"
+    
+    # Slurm rules
+    _SLURM_TEMPLATE = """\
+#SBATCH --time={time}
+#SBATCH --nodes={nodes}
+#SBATCH --tasks-per-node={tasks}
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --ntasks={ntasks}
+#SBATCH --error={cname}.e
+#SBATCH --output={cname}.o
+#SBATCH --qos={qos}
+
+cd $SLURM_SUBMIT_DIR"""
+
+    # Stage specific script contents (formatted with the '_params' values)
+    _TEMPLATE = ""
 
     # Obtain common script header 
     def _getHeader(self):
-        self.lines.append("#!/bin/bash")
-        self.lines.append("")
+        self.lines.append(self._HEADER)
         
     # Build specific slurm rules
     def _getSlurmRules(self, tlimit, nodes, tasks, cpus, qos):
-
-        #Obtain class name
-        cname = self._className()
         
         # Set time estimation
         self.time = tlimit
                 
         # Add rules to the slurm script
-        self.lines.append("#SBATCH --time=" + time.strftime('%H:%M:%S', time.gmtime(tlimit)))
-        self.lines.append("#SBATCH --nodes=" + str(nodes))
-        self.lines.append("#SBATCH --tasks-per-node=" + str(tasks))
-        self.lines.append("#SBATCH --cpus-per-task=" + str(cpus))
-        self.lines.append("#SBATCH --ntasks=" + str(int(nodes) * int(tasks)))
-        self.lines.append("#SBATCH --error=" + cname + ".e")
-        self.lines.append("#SBATCH --output=" + cname + ".o")
-        self.lines.append("#SBATCH --qos=" + qos)
-        self.lines.append("")
-        self.lines.append("cd $SLURM_SUBMIT_DIR")
+        self.lines.append(self._SLURM_TEMPLATE.format_map({
+            "time": _hms(int(tlimit)),
+            "nodes": nodes, "tasks": tasks, "cpus": cpus,
+            "ntasks": int(nodes) * int(tasks),
+            "cname": self.cname, "qos": qos}))
+        
+    # Values available to all the scripts templates (plus the given ones)
+    def _params(self, **params):
+        # Just some shortcuts
+        inp = self.config["input"]
+        setup = self.config["compute"]["setup"]
+        
+        params.update(site=self.site, runID=self.runID, files=self.files,
+                      cRunpath=self.config["output"]["cRunpath"],
+                      cs=inp["cyberShake"]["path"],
+                      db=inp["database"]["path"],
+                      erf=inp["ERF"]["id"],
+                      frequency=setup["frequency"],
+                      sourceFrequency=setup["sourceFrequency"])
+        return params
+    
+    # Add the stage specific contents to the script
+    def _getBody(self, **params):
+        self.lines.append(self._TEMPLATE.format_map(self._params(**params)))
         
     # Generate script
     def _saveScript(self):
-        
-        # Generate the specific script
-        file = self._className() + "." + self.type
-        with open(file, 'w') as f:
-            for item in self.lines:
-                f.write("%s\n" % item)
+        self._writeScript(("\n".join(self.lines) + "\n").encode())
+        
+    # Write the given script contents (in a single write)
+    def _writeScript(self, data):
+        file = f"{self.cname}.{self.type}"
+        
+        # Execution permisions are assigned on creation (bits in the umask are not set)
+        fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
     
-        # Assign execution permisions to the script
-        os.chmod(file, 0o777)
+    # Mark the stage as done (written right away, as it is the restart point of the site)
+    def _markStage(self):
+        file = self.config["compute"]["restartFile"]
+        
+        # The tag is replaced atomically, so a crash never leaves an empty/partial marker
+        fd = os.open(file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, self.tag)
+        finally:
+            os.close(fd)
+        os.replace(file + ".tmp", file)
                 
     # Method in charge of run and wait the script
     def run(self):
 
         # Build the script filename 
-        script = os.path.abspath(self._className() + "." + self.type)
+        script = os.path.abspath(f"{self.cname}.{self.type}")
         
         # Decide how to execute the script
         if self.type == "slurm":
-            Runner(self._className(), self.time).enqueueSlurm(script, self.id)
+            Runner(self.cname, self.time).enqueueSlurm(script, self.id)
         else:
-            Runner(self._className(), self.time).runBashScript(script)
+            Runner(self.cname, self.time).runBashScript(script)
         
         pass
 
@@ -172,16 +298,12 @@ class Runner():
     message = ""
     time = 0
     task = ""
-    resultAvailable = None
     
     # Initialization method
     def __init__(self, task, tlimit):
         # Task name
         self.task = task
         
-        # Initialize the synchronizerpos
-        self.resultAvailable = threading.Event()
-        
         # Time limit
         self.time = tlimit
         
@@ -191,7 +313,7 @@ class Runner():
         
         # Run the command and wait
         process = subprocess.run(cmd, stdout=subprocess.PIPE,
-        stdin=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
         stderr=subprocess.PIPE,
         encoding='utf8')
         
@@ -200,703 +322,551 @@ class Runner():
             raise Exception("Command '" + cmd + "' failed. Error: " + process.stderr)
             pass
     
-    # Enqueue a process and wait
+    # Enqueue a process and wait (the job is supervised from a single thread)
     def enqueueSlurm(self, cmd, id):
+        asyncio.run(self._enqueueSlurm(cmd, id))
+        
+    # Run a command (no shell involved) and obtain its return code and outputs
+    async def _exec(self, argv):
+        process = await asyncio.create_subprocess_exec(*argv,
+                                                       stdout=subprocess.PIPE,
+                                                       stdin=subprocess.DEVNULL,
+                                                       stderr=subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+        return process.returncode, stdout.decode('utf8'), stderr.decode('utf8')
+    
+    # Enqueue a process and wait
+    async def _enqueueSlurm(self, cmd, id):
 
         # Run the command and wait
-        cmdm = 'sbatch ' +  cmd
+        argv = ['sbatch', cmd]
     
-        process = subprocess.run(cmdm, shell=True, 
-                                       stdout=subprocess.PIPE,
-                                       stdin=subprocess.PIPE,
-                                       stderr=subprocess.PIPE,
-                                       encoding='utf8')
+        returncode, stdout, stderr = await self._exec(argv)
         
         # Check for and error
-        if process.returncode != 0:
-            raise Exception("Command '" + cmdm + "' failed. Error: " + process.stderr)
+        if returncode != 0:
+            raise Exception("Command '" + " ".join(argv) + "' failed. Error: " + stderr)
             
-        # Obtain the job ID
-        jobId = [x.strip() for x in process.stdout.split(' ')][3]
+        # Obtain the job ID (the first number in the output)
+        match = JOB_ID.search(stdout)
+        if not match:
+            raise Exception("Unexpected output from '" + " ".join(argv) + "': " + stdout)
+        jobId = match.group()
         
-        thread = threading.Thread(target=self._waitForSlurmJob, args=(jobId,))
-        thread.start()
+        job = asyncio.ensure_future(self._waitForSlurmJob(jobId))
         
         # Wait for the process to finish
         pbar = tqdm(total = self.time, position=id, leave=False)
         timeout = 1
-        while not self.resultAvailable.wait(timeout=timeout):
+        start = time.monotonic()
+        lastMessage = None
+        while not (await asyncio.wait({job}, timeout=timeout))[0]:
             #print('\r{}'.format(self.time), end='', flush=True)
-            pbar.set_description("     STATUS: %s" % (self.message))
-            pbar.update(timeout)
+            # The status is only rebuilt when it changes (drawn by the next update)
+            if self.message != lastMessage:
+                lastMessage = self.message
+                pbar.set_description("     STATUS: %s" % lastMessage, refresh=False)
+            
+            # Advance the bar by the (whole) seconds actually elapsed
+            pbar.update(int(time.monotonic() - start) - pbar.n)
+        
+        # Errors while waiting for the job are raised here
+        job.result()
 
-        pbar.set_description("STATUS: %s" % self.task + " completed!")
+        pbar.set_description(f"STATUS: {self.task} completed!")
         pbar.close()            
         
     # Wait for a Slurm job to finish
-    def _waitForSlurmJob(self, jobId):
+    async def _waitForSlurmJob(self, jobId):
 
-        # Wait for the job to finish
+        # Query for the job state (built only once)
+        argv = SQUEUE_ARGV + [jobId]
+        
+        # Wait for the job to finish (polling less often as time goes by)
+        delay = 2.0
         while True:
-            # Query for the job state
-            cmd = 'squeue -h -o "Slurm job %T (%M of %l)" --job ' + jobId
-            process = subprocess.run(cmd, shell=True,
-                                          stdout=subprocess.PIPE,
-                                          stdin=subprocess.PIPE,
-                                          stderr=subprocess.PIPE,
-                                          encoding='utf8')
+            returncode, stdout, stderr = await self._exec(argv)
                                                                                        
             # Check for and error
-            if process.returncode != 0:
-                raise Exception("Command '" + cmd + "' failed. Error: " + process.stderr)                                                      
+            if returncode != 0:
+                raise Exception("Command '" + " ".join(argv) + "' failed. Error: " + stderr)                                                      
         
             # Set a message
-            self.message = process.stdout.rstrip()
+            self.message = stdout.rstrip()
             
             # Stop condition
-            if process.stdout == "":
+            if stdout == "":
                 break
-
-        # Results are available
-        self.resultAvailable.set()
+            
+            # Wait before the next query (up to a minute)
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 60.0)
             
 # Stage "PreSGT" definition
 class preSGT(scriptABC):
     # Attributes     
     type = "slurm"       # Script type
-    
+
+    # Script contents
+    _TEMPLATE = "export PYTHONPATH={cRunpath}:$PYTHONPATH\n" + PY27 + """
+{cs}/PreSgt/presgt.py {site} {erf} {box} {gridOut} {coords} \
+{files[fdloc]} {files[faultlist]} {files[radiusfile]} {files[coordfile]} {db} {spacing} {frequency}"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        self._getSlurmRules(r["time"]/6, 1, 1, r["task-per-node"], r["qos"])
-        
-        # Additional instructions
-        self.lines.append("export PYTHONPATH=" + self.config["output"]["cRunpath"] + ":$PYTHONPATH")
-        self.lines.append("module load python/2.7.16")
-        self.lines.append("")           
+        r = self.resources
+        self._getSlurmRules(r.time/6, 1, 1, r.tasks, r.qos)
         
-        # Build command
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/PreSgt/presgt.py")
-        cmd.append(self.site)
-        cmd.append(str(self.config["input"]["ERF"]["id"]))
-        cmd.append(self.config["input"]["model"]["box"])
-        cmd.append(self.config["input"]["model"]["gridOut"])
-        cmd.append(self.config["input"]["model"]["coords"])
-
-        outs = Workflow.OUTPUTS
-        cmd.append(self.site + "." + Workflow.OUTPUTS["fdloc"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["faultlist"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["radiusfile"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["coordfile"])
-        
-        cmd.append(self.config["input"]["database"]["path"])
-        
-        cmd.append(str(self.config["compute"]["setup"]["spacing"]))
-        cmd.append(str(self.config["compute"]["setup"]["frequency"]))
-        
-        self.lines.append(" ".join(cmd))
+        # Script contents
+        model = self.config["input"]["model"]
+        self._getBody(box=model["box"], gridOut=model["gridOut"], coords=model["coords"],
+                      spacing=self.config["compute"]["setup"]["spacing"])
 
         # Save the script to disk
         self._saveScript()
-        
-        pass
-            
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('preSGT')
+        self._markStage()
 
 # Stage "PreAWP" definition
 class preAWP(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = PY27 + """\
+ln -s {mpath} awp.{site}.media
+
+{cs}/AWP-ODC-SGT/utils/build_awp_inputs.py --site {site} --gridout {gridOut} \
+--fdloc {files[fdloc]} --cordfile {files[coordfile]} --frequency {frequency} --px {px} --py {py} \
+--pz {pz} --source-frequency {sourceFrequency} --run_id {runID} --velocity-mesh {mpath}"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        self._getSlurmRules(r["time"]/6, 1, 1, r["task-per-node"], r["qos"])
+        r = self.resources
+        self._getSlurmRules(r.time/6, 1, 1, r.tasks, r.qos)
         
-        # Additional instructions
-        self.lines.append("module load python/2.7.16")
-        
-        self.lines.append("ln -s " + self.config["input"]["model"]["path"] + " awp." + self.site + ".media")
-        self.lines.append("")
-                
-        # Build command
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/AWP-ODC-SGT/utils/build_awp_inputs.py")        
-        cmd.append("--site " + self.site)
-        cmd.append("--gridout " + self.config["input"]["model"]["gridOut"])
-        cmd.append("--fdloc " + self.site + "." + Workflow.OUTPUTS["fdloc"])
-        cmd.append("--cordfile " + self.site + "." + Workflow.OUTPUTS["coordfile"])
-        cmd.append("--frequency " + str(self.config["compute"]["setup"]["frequency"]))
-        cmd.append("--px " + str(self.config["compute"]["decomposition"]["x"]))
-        cmd.append("--py " + str(self.config["compute"]["decomposition"]["y"]))
-        cmd.append("--pz " + str(self.config["compute"]["decomposition"]["z"]))
-        cmd.append("--source-frequency " + str(self.config["compute"]["setup"]["sourceFrequency"]))        
-        cmd.append("--run_id " + str(self.runID))
-        cmd.append("--velocity-mesh " + self.config["input"]["model"]["path"])
-        
-        self.lines.append(" ".join(cmd))
+        # Script contents
+        model = self.config["input"]["model"]
+        dd = self.config["compute"]["decomposition"]
+        self._getBody(mpath=model["path"], gridOut=model["gridOut"],
+                      px=dd["x"], py=dd["y"], pz=dd["z"])
 
         # Save the script to disk
-        self._saveScript()        
-        
-        pass
-    
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('preAWP')
+        self._markStage()
 
 # Stage "AWPX" definition
 class AWPX(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = MOD_SWAP + """
+export CYBERSHAKE_HOME={cs}
+
+{cs}/AWP-ODC-SGT/awp_odc_wrapper.sh {ntasks} IN3D.{site}.x"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
+        r = self.resources
         dd = self.config["compute"]["decomposition"]
         ntasks = int(dd["x"]) * int(dd["y"]) * int(dd["z"])
-        nodes = int(r["nodes"])
+        nodes = int(r.nodes)
         tnode = math.ceil(float(ntasks)/nodes)
         
-        self._getSlurmRules(r["time"], nodes, tnode, r["cpus-per-task"], r["qos"])
+        self._getSlurmRules(r.time, nodes, tnode, r.cpus, r.qos)
         
-        # Additional instructions
-        self.lines.append("module swap intel gcc")
-        self.lines.append("ulimit -c unlimited")
-        self.lines.append("")            
-
-        # Additional instructions        
-        self.lines.append("export CYBERSHAKE_HOME="\
-                         + self.config["input"]["cyberShake"]["path"])
-        self.lines.append("")                         
-        
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/AWP-ODC-SGT/awp_odc_wrapper.sh")        
-        cmd.append(str(ntasks))
-        cmd.append("IN3D." + self.site + ".x")
-        
-        self.lines.append(" ".join(cmd))
+        # Script contents
+        self._getBody(ntasks=ntasks)
 
         # Save the script to disk
-        self._saveScript()    
-        
-        pass
-    
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('AWPX')
+        self._markStage()
 
 # Stage "AWPY" definition
 class AWPY(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = MOD_SWAP + """
+export CYBERSHAKE_HOME={cs}
+
+{cs}/AWP-ODC-SGT/awp_odc_wrapper.sh {ntasks} IN3D.{site}.y"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
+        r = self.resources
         dd = self.config["compute"]["decomposition"]
         ntasks = int(dd["x"]) * int(dd["y"]) * int(dd["z"])
-        nodes = int(r["nodes"])
+        nodes = int(r.nodes)
         tnode = math.ceil(float(ntasks)/nodes)
         
-        self._getSlurmRules(r["time"], nodes, tnode, r["cpus-per-task"], r["qos"])
+        self._getSlurmRules(r.time, nodes, tnode, r.cpus, r.qos)
         
-        # Additional instructions
-        self.lines.append("module swap intel gcc")
-        self.lines.append("ulimit -c unlimited")
-        self.lines.append("")          
-
-        # Additional instructions        
-        self.lines.append("export CYBERSHAKE_HOME="\
-                         + self.config["input"]["cyberShake"]["path"])
-        self.lines.append("")
-        
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/AWP-ODC-SGT/awp_odc_wrapper.sh")        
-        cmd.append(str(ntasks))
-        cmd.append("IN3D." + self.site + ".y")
-        
-        self.lines.append(" ".join(cmd))
+        # Script contents
+        self._getBody(ntasks=ntasks)
 
         # Save the script to disk
-        self._saveScript()      
-              
-        pass
-    
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('AWPY')
+        self._markStage()
 
 # Stage "checkX" definition
 class checkX(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = PY27 + """
+{cs}/SgtTest/perform_checks.py comp_x/output_sgt/awp-strain-{site}-fx {files[coordfile]} \
+IN3D.{site}.x"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        nodes = int(self.config["compute"]["decomposition"]["x"])
-        ntasks = nodes*r["task-per-node"]
-        
-        self._getSlurmRules(r["time"]*0.5, 1, 1, r["task-per-node"], r["qos"])
-        
-        # Additional instructions
-        self.lines.append("module load python/2.7.16")
-        self.lines.append("")
+        r = self.resources
+        self._getSlurmRules(r.time*0.5, 1, 1, r.tasks, r.qos)
         
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/SgtTest/perform_checks.py")        
-        cmd.append("comp_x/output_sgt/awp-strain-" + self.site + "-fx")
-        cmd.append(self.site + "." + Workflow.OUTPUTS["coordfile"])        
-        cmd.append("IN3D." + self.site + ".x")
-        
-        self.lines.append(" ".join(cmd))
+        # Script contents
+        self._getBody()
 
         # Save the script to disk
-        self._saveScript()            
-        pass
-    
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('checkX')
+        self._markStage()
 
 # Stage "checkY" definition
 class checkY(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = PY27 + """
+{cs}/SgtTest/perform_checks.py comp_y/output_sgt/awp-strain-{site}-fy {files[coordfile]} \
+IN3D.{site}.y"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        nodes = int(self.config["compute"]["decomposition"]["x"])
-                
-        self._getSlurmRules(r["time"]*0.5, 1, 1, r["task-per-node"], r["qos"])
-        
-        # Additional instructions
-        self.lines.append("module load python/2.7.16")        
-        self.lines.append("")
-        
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/SgtTest/perform_checks.py")        
-        cmd.append("comp_y/output_sgt/awp-strain-" + self.site + "-fy")
-        cmd.append(self.site + "." + Workflow.OUTPUTS["coordfile"])        
-        cmd.append("IN3D." + self.site + ".y")
+        r = self.resources
+        self._getSlurmRules(r.time*0.5, 1, 1, r.tasks, r.qos)
         
-        self.lines.append(" ".join(cmd))
+        # Script contents
+        self._getBody()
 
         # Save the script to disk
-        self._saveScript()            
-        pass
-        
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('checkY')
+        self._markStage()
         
 # Stage "postX" definition
 class postX(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = PY27 + """
+{cs}/AWP-GPU-SGT/utils/prepare_for_pp.py {site} comp_x/output_sgt/awp-strain-{site}-fx \
+{site}_fy_{runID}.sgt {box} {files[coordfile]} {files[fdloc]} {gridOut} IN3D.{site}.x \
+awp.{site}.media x {runID} {site}_fy_{runID}.sgthead {frequency} -s {sourceFrequency}"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        self._getSlurmRules(r["time"]/6, 1, 1, r["task-per-node"], r["qos"])
-        
-        # Additional instructions
-        self.lines.append("module load python/2.7.16")
-        self.lines.append("")
-        
-        # Build command
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/AWP-GPU-SGT/utils/prepare_for_pp.py")
-        cmd.append(self.site)
-        cmd.append("comp_x/output_sgt/awp-strain-" + self.site + "-fx")
-        cmd.append(self.site + "_fy_" + str(self.runID) + ".sgt")
-        cmd.append(self.config["input"]["model"]["box"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["coordfile"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["fdloc"])
-        cmd.append(self.config["input"]["model"]["gridOut"])
-        cmd.append("IN3D." + self.site + ".x")
-        cmd.append("awp." + self.site+ ".media")
-        cmd.append("x")
-        cmd.append(str(self.runID))
-        cmd.append(self.site + "_fy_" + str(self.runID) + ".sgthead")
-        cmd.append(str(self.config["compute"]["setup"]["frequency"]))
-        cmd.append("-s " + str(self.config["compute"]["setup"]["sourceFrequency"]))
-
-        self.lines.append(" ".join(cmd))
+        r = self.resources
+        self._getSlurmRules(r.time/6, 1, 1, r.tasks, r.qos)
+        
+        # Script contents
+        model = self.config["input"]["model"]
+        self._getBody(box=model["box"], gridOut=model["gridOut"])
 
         # Save the script to disk
-        self._saveScript()                 
-        pass
-    
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('postX')
+        self._markStage()
         
 # Stage "postY" definition
 class postY(scriptABC):
     # Script type
     type = "slurm"
-        
+
+    # Script contents
+    _TEMPLATE = PY27 + """
+{cs}/AWP-GPU-SGT/utils/prepare_for_pp.py {site} comp_y/output_sgt/awp-strain-{site}-fy \
+{site}_fx_{runID}.sgt {box} {files[coordfile]} {files[fdloc]} {gridOut} IN3D.{site}.y \
+awp.{site}.media y {runID} {site}_fx_{runID}.sgthead {frequency} -s {sourceFrequency}"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        self._getSlurmRules(r["time"]/6, 1, 1, r["task-per-node"], r["qos"])
-        
-        # Additional instructions
-        self.lines.append("module load python/2.7.16")
-        self.lines.append("")        
-        
-        # Build command
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/AWP-GPU-SGT/utils/prepare_for_pp.py")
-        cmd.append(self.site)
-        cmd.append("comp_y/output_sgt/awp-strain-" + self.site + "-fy")
-        cmd.append(self.site + "_fx_" + str(self.runID) + ".sgt")
-        cmd.append(self.config["input"]["model"]["box"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["coordfile"])
-        cmd.append(self.site + "." + Workflow.OUTPUTS["fdloc"])
-        cmd.append(self.config["input"]["model"]["gridOut"])
-        cmd.append("IN3D." + self.site + ".y")
-        cmd.append("awp." + self.site+ ".media")
-        cmd.append("y")
-        cmd.append(str(self.runID))
-        cmd.append(self.site + "_fx_" + str(self.runID) + ".sgthead")
-        cmd.append(str(self.config["compute"]["setup"]["frequency"]))
-        cmd.append("-s " + str(self.config["compute"]["setup"]["sourceFrequency"]))                      
-
-        self.lines.append(" ".join(cmd))
+        r = self.resources
+        self._getSlurmRules(r.time/6, 1, 1, r.tasks, r.qos)
+        
+        # Script contents
+        model = self.config["input"]["model"]
+        self._getBody(box=model["box"], gridOut=model["gridOut"])
 
         # Save the script to disk
-        self._saveScript()        
-        pass
-    
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('postY')
+        self._markStage()
 
 # Stage "rupVar" definition
 class rupVar(scriptABC):
     # Script type
     type = "sh"
-        
+
+    # Script contents
+    _TEMPLATE = PY27 + """
+{cs}/populate_rvs.py {gravesPitarka} {erf} 1 {db}
+mkdir post-processing
+cd post-processing"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
-        # Build command
-        cmd = []
-        self.lines.append("module load python/2.7.16")
-        self.lines.append("")
-        
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/populate_rvs.py")
-        cmd.append(str(self.config["input"]["cyberShake"]["gravesPitarka"]))
-        cmd.append(str(self.config["input"]["ERF"]["id"]))
-        cmd.append("1")
-        cmd.append(self.config["input"]["database"]["path"])
-
-        self.lines.append(" ".join(cmd))
-                
-        self.lines.append("mkdir post-processing")
-        self.lines.append("cd post-processing")
+        # Script contents
+        self._getBody(gravesPitarka=self.config["input"]["cyberShake"]["gravesPitarka"])
         
         # Save the script to disk
         self._saveScript()
-                    
-        pass
-    
+
     def postprocess(self):
         # Generate the rupture file list
-        dal = DAL.SQLiteHandler(self.config["input"]["database"]["path"], True)
-        dal.generateRuptureFile("post-processing/rupture_file_list_" + self.config["input"]["region"])
+        with self.workflow.lock:
+            self.workflow.dal.generateRuptureFile("post-processing/rupture_file_list_"
+                                                  + self.config["input"]["region"])
         
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('rupVar')        
+        self._markStage()        
         
 # Stage "runDS" definition
 class runDS(scriptABC):
     # Script type
     type = "slurm"
-                
+
+    # Script contents
+    _TEMPLATE = """\
+module purge
+module load impi/2017.4
+module load gcc
+module load fftw
+ulimit -c unlimited
+
+cd post-processing/
+ln -s ../{site}_fx_{runID}.sgt
+ln -s ../{site}_fy_{runID}.sgt
+ln -s ../{site}_fx_{runID}.sgthead
+ln -s ../{site}_fy_{runID}.sgthead
+{cs}/make_lns.py rupture_file_list_{region} {ruptures}Ruptures_erf{erf}/
+
+{cs}/DirectSynth/direct_synth.py {gravesPitarka} stat={site} slat={lat} slon={lon} \
+sgt_handlers=84 run_id={runID} debug=1 max_buf_mb=512 rupture_spacing=uniform ntout=3000 \
+rup_list_file=rupture_file_list_{region} sgt_xfile={site}_fx_{runID}.sgt \
+sgt_yfile={site}_fy_{runID}.sgt x_header={site}_fx_{runID}.sgthead \
+y_header={site}_fy_{runID}.sgthead det_max_freq={frequency} stoch_max_freq=-1.0 run_psa=1 \
+run_rotd=1 run_durations=1 dtout=0.1 simulation_out_pointsX=2 simulation_out_pointsY=1 \
+simulation_out_timesamples=3000 simulation_out_timeskip=0.1 \
+surfseis_rspectra_seismogram_units=cmpersec surfseis_rspectra_output_units=cmpersec2 \
+surfseis_rspectra_output_type=aa surfseis_rspectra_period=all \
+surfseis_rspectra_apply_filter_highHZ=5.0 surfseis_rspectra_apply_byteswap=no
+cd .."""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
         # Obtain Slurm rules
-        r = self.config["compute"]["resources"]
-        #self._getSlurmRules(r["time"], r["nodes"],
-        #                    r["task-per-node"], r["cpus-per-task"], r["qos"])
-        self._getSlurmRules(r["time"], r["nodes"],
-                            int(r["task-per-node"]/2), r["cpus-per-task"]*2, r["qos"])
-        
-        # Additional instructions
-        #self.lines.append("module load python/2.7.16")
-            
-        self.lines.append("module purge")
-        self.lines.append("module load impi/2017.4")
-        self.lines.append("module load gcc")
-        self.lines.append("module load fftw")
-        
-        self.lines.append("ulimit -c unlimited")
-        self.lines.append("")
-
-        self.lines.append("cd post-processing/")
-        self.lines.append("ln -s ../" + self.site + "_fx_" + str(self.runID) + ".sgt")
-        self.lines.append("ln -s ../" + self.site + "_fy_" + str(self.runID) + ".sgt")
-        self.lines.append("ln -s ../" + self.site + "_fx_" + str(self.runID) + ".sgthead")
-        self.lines.append("ln -s ../" + self.site + "_fy_" + str(self.runID) + ".sgthead")
-
-        cmd = []        
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/make_lns.py")
-        cmd.append("rupture_file_list_" + self.config["input"]["region"])
-        cmd.append(self.config["input"]["ERF"]["ruptures"] + "Ruptures_erf" 
-                   + str(self.config["input"]["ERF"]["id"]) + "/")
-        self.lines.append(" ".join(cmd))
-        self.lines.append("")
-
+        r = self.resources
+        #self._getSlurmRules(r.time, r.nodes,
+        #                    r.tasks, r.cpus, r.qos)
+        tasks, cpus = self._autosize()
+        self._getSlurmRules(r.time, r.nodes, tasks, cpus, r.qos)
+        
         # Obtain the site's location
-        dal = DAL.SQLiteHandler(self.config["input"]["database"]["path"], True)
-        lat, lon = dal.getSiteLocation(self.site)
-                
-        # Build command
-        cmd = []
-        cyberShake = self.config["input"]["cyberShake"]
-        cmd.append(cyberShake["path"] + "/DirectSynth/direct_synth.py")
-        cmd.append(cyberShake["gravesPitarka"])
-        cmd.append("stat=" + self.site)
-        cmd.append("slat=" + str(lat))
-        cmd.append("slon=" + str(lon))
-        cmd.append("sgt_handlers=84")
-        cmd.append("run_id=" + str(self.runID))
-        cmd.append("debug=1")
-        cmd.append("max_buf_mb=512")
-        cmd.append("rupture_spacing=uniform")
-        cmd.append("ntout=3000")
-        cmd.append("rup_list_file=rupture_file_list_" + self.config["input"]["region"])
-        cmd.append("sgt_xfile=" + self.site + "_fx_" + str(self.runID) + ".sgt")
-        cmd.append("sgt_yfile=" + self.site + "_fy_" + str(self.runID) + ".sgt")
-        cmd.append("x_header=" + self.site + "_fx_" + str(self.runID) + ".sgthead")
-        cmd.append("y_header=" + self.site + "_fy_" + str(self.runID) + ".sgthead")
-        cmd.append("det_max_freq=" + str(self.config["compute"]["setup"]["frequency"]))
-        cmd.append("stoch_max_freq=-1.0")
-        cmd.append("run_psa=1")
-        cmd.append("run_rotd=1")
-        cmd.append("run_durations=1")
-        cmd.append("dtout=0.1")
-        cmd.append("simulation_out_pointsX=2")
-        cmd.append("simulation_out_pointsY=1")
-        cmd.append("simulation_out_timesamples=3000")
-        cmd.append("simulation_out_timeskip=0.1")
-        cmd.append("surfseis_rspectra_seismogram_units=cmpersec")
-        cmd.append("surfseis_rspectra_output_units=cmpersec2")
-        cmd.append("surfseis_rspectra_output_type=aa")
-        cmd.append("surfseis_rspectra_period=all")
-        cmd.append("surfseis_rspectra_apply_filter_highHZ=5.0")
-        cmd.append("surfseis_rspectra_apply_byteswap=no")
-        
-        self.lines.append(" ".join(cmd))
-        
-        self.lines.append("cd ..")
+        with self.workflow.lock:
+            lat, lon = self.workflow.dal.getSiteLocation(self.site)
+        
+        # Script contents
+        inp = self.config["input"]
+        self._getBody(region=inp["region"], ruptures=inp["ERF"]["ruptures"],
+                      gravesPitarka=inp["cyberShake"]["gravesPitarka"], lat=lat, lon=lon)
         
         # Save the script to disk
         self._saveScript()
+
+    # Tasks per node and CPUs per task (two CPUs per task over all the cores requested per
+    # node, unless they are given in the "runDS" compute section). The cores are taken from
+    # the configuration, as the scripts are not generated on the compute nodes
+    def _autosize(self):
+        r = self.resources
+        override = self.config["compute"].get("runDS", {})
         
+        cpus = 2
+        tasks = max(1, int(r.tasks) * int(r.cpus) // cpus)
+        return override.get("task-per-node", tasks), override.get("cpus-per-task", cpus)
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('runDS')
+        self._markStage()
         
 # Stage "db_insert" definition
 class insertDB(scriptABC):
     # Script type
     type = "sh"
-        
+
+    # Script contents
+    _TEMPLATE = """\
+export CYBERCOMMANDS_JARS='{cs}/CyberCommands/lib'
+
+n=0
+until [ "$n" -ge 10 ]
+do
+{cs}/CyberCommands/bin/CyberLoadAmps_SC -c -r -p post-processing -run {runID} \
+-server sqlite:{db} -periods {periods} && break
+   n=$((n+1))
+   sleep 15
+done"""
+
     def build(self):
         # Obtain Header 
         self._getHeader()
         
-        # Additional instructions        
-        self.lines.append("export CYBERCOMMANDS_JARS='"\
-                         + self.config["input"]["cyberShake"]["path"]\
-                         + "/CyberCommands/lib'")
-        self.lines.append("")                         
-
-        # Build command
-        self.lines.append("n=0")
-        self.lines.append('until [ "$n" -ge 10 ]')
-        self.lines.append("do")
-
-        cmd = []
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/CyberCommands/bin/CyberLoadAmps_SC")
-        cmd.append("-c -r -p post-processing")
-        cmd.append("-run " + str(self.runID))
-        cmd.append("-server sqlite:" + self.config["input"]["database"]["path"])
-        cmd.append("-periods " + ",".join(str(x) for x in self.config["compute"]["setup"]["periods"]))
-
-        self.lines.append(" ".join(cmd) + " && break")
-
-        self.lines.append("   n=$((n+1))")
-        self.lines.append("   sleep 15")
-        self.lines.append("done")
+        # Script contents
+        periods = _periodsCSV(tuple(self.config["compute"]["setup"]["periods"]))
+        self._getBody(periods=periods)
         
         # Save the script to disk
         self._saveScript()
-                
-        pass
-    
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('insertDB')
+        self._markStage()
         
 # Stage "check_db" definition
 class checkDB(scriptABC):
     # Script type
     type = "sh"
-        
+
+    # Script contents
+    _TEMPLATE = """\
+set -o errexit
+cd {cs}/db
+
+java -classpath .:sqlite-jdbc-3.27.2.1.jar:mysql-connector-java-5.0.5-bin.jar:commons-cli-1.0.jar \
+CheckDBDataForSite -s sqlite:{db} -r {runID} -o check.out -c rotd -p {periods}
+
+cd -"""
+
     def build(self):
-        # Main path
-        path = self.config["input"]["cyberShake"]["path"]
         # Obtain Header 
         self._getHeader()
         
-        # Additional instructions        
-        self.lines.append("set -o errexit")
-        
-        self.lines.append("cd " + path + "/db")
-        self.lines.append("")
-        
-        # Build command
-        cmd = []
-        cmd.append("java -classpath .:sqlite-jdbc-3.27.2.1.jar:mysql-connector-java-5.0.5-bin.jar:commons-cli-1.0.jar CheckDBDataForSite")
-        cmd.append("-s sqlite:" + self.config["input"]["database"]["path"])
-        cmd.append("-r " + str(self.runID))
-        cmd.append("-o check.out")
-        cmd.append("-c rotd")
-        cmd.append("-p " + ",".join(str(x) for x in self.config["compute"]["setup"]["periods"]))
-
-        self.lines.append(" ".join(cmd))
-        
-        self.lines.append("")
-        self.lines.append("cd -")
+        # Script contents
+        periods = _periodsCSV(tuple(self.config["compute"]["setup"]["periods"]))
+        self._getBody(periods=periods)
         
         # Save the script to disk
         self._saveScript()
-                        
-        pass
-    
+
     def postprocess(self):
         # Inser Hazard dataset
-        dal = DAL.SQLiteHandler(self.config["input"]["database"]["path"], True)
+        with self.workflow.lock:
+            dal = self.workflow.dal
+            
+            # Obtain information for a given RunID
+            runInfo = dal.getRunIDInfo(self.runID)
         
-        # Obtain information for a given RunID
-        runInfo = dal.getRunIDInfo(self.runID)
-    
-        # Insert a Hazard dataset
-        erfID = runInfo['ERF_ID']
-        rupVarScenarioID = runInfo['Rup_Var_Scenario_ID']
-        SGTID = runInfo['SGT_Variation_ID']
-        velModelID = runInfo['Velocity_Model_ID']
-        dal.addHazardDataset(erfID, rupVarScenarioID, SGTID, velModelID, 
-            self.config['compute']['setup']['frequency'])
+            # Insert a Hazard dataset
+            erfID = runInfo['ERF_ID']
+            rupVarScenarioID = runInfo['Rup_Var_Scenario_ID']
+            SGTID = runInfo['SGT_Variation_ID']
+            velModelID = runInfo['Velocity_Model_ID']
+            dal.addHazardDataset(erfID, rupVarScenarioID, SGTID, velModelID, 
+                self.config['compute']['setup']['frequency'])
         
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('checkDB')
+        self._markStage()
             
 # Stage "curve_calc" definition
 class curveCalc(scriptABC):
     # Script type
     type = "sh"
-        
+
+    # Script contents
+    _TEMPLATE = """\
+CYBERSHAKE_HOME={cs} {cs}/OpenSHA/scripts/curve_plot_wrapper.sh {db} --site {site} --run-id {runID} \
+--erf-file {cs}""" + XML_PATH + """ \
+--period {periods} --output-dir {cRunpath}/ """ + CURVE_OPTIONS
+
     def build(self):
         # Obtain Header 
         self._getHeader()
-            
-        # Build command
-        cmd = []
-        cmd.append("CYBERSHAKE_HOME=" + self.config["input"]["cyberShake"]["path"])
-        cmd.append(self.config["input"]["cyberShake"]["path"] + "/OpenSHA/scripts/curve_plot_wrapper.sh")
-        cmd.append(self.config["input"]["database"]["path"])
-        cmd.append("--site " + self.site)
-        cmd.append("--run-id " + str(self.runID))
-        xmlPath = "/OpenSHA//opensha-cybershake/src/org/opensha/sha/cybershake/conf/MeanICERF.xml"
-        cmd.append("--erf-file " + self.config["input"]["cyberShake"]["path"] + xmlPath)
-        cmd.append("--period " + ",".join(str(x) for x in self.config["compute"]["setup"]["periods"]))        
-        cmd.append("--output-dir " + os.path.abspath(".") + "/")
-        cmd.append("--type pdf,png")
-        cmd.append("--force-add")
-        cmd.append("--cmp RotD50")
-        
-        self.lines.append(" ".join(cmd))
         
-        # Save the script to disk
-        self._saveScript()        
+        # Script contents (the stage runs from the site directory, cRunpath)
+        periods = _periodsCSV(tuple(self.config["compute"]["setup"]["periods"]))
+        self._getBody(periods=periods)
         
-        pass
-    
+        # Save the script to disk
+        self._saveScript()
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('curveCalc')
+        self._markStage()
      
         
 # Stage "cleanUp" definition
 class cleanUp(scriptABC):
     # Script type
     type = "sh"
-        
-    def build(self):
-        # Obtain Header 
-        self._getHeader()
-        
-        # Additional instructions        
-        self.lines.append("rm -fr *sgt")
-        self.lines.append("rm -fr comp_*/output_sgt/*")          
 
+    # The whole script is static (rendered only once)
+    _SCRIPT = ("\n".join((scriptABC._HEADER,) + CLEANUP_LINES) + "\n").encode()
+
+    def build(self):
         # Save the script to disk
-        self._saveScript()
-                
-        pass
-    
+        self._writeScript(self._SCRIPT)
+
     def postprocess(self):
         # Write to stage.txt
-        with open(self.config["compute"]["restartFile"], 'w') as f:
-            f.write('cleanUp')
+        self._markStage()